@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+import socket
+import sys
+
+
+# The Unix domain socket on which "battery_control.py daemon" listens for
+# commands. This should match BatteryController._SOCKET_FILENAME. We don't
+# import battery_control to get it, because the point of battery_client.py is
+# to avoid the cost of importing battery_control's dependencies.
+_SOCKET_FILENAME = '/path/to/battery_control.sock'
+
+# The number of seconds to wait for the daemon to perform a command before
+# giving up. This should be long enough for the daemon to wait for the state
+# file's lock and to communicate with the smart plug.
+_TIMEOUT = 90
+
+
+def send_command(command):
+    """Send a command to ``BatteryController.daemon()`` and await the result.
+
+    Arguments:
+        command (str): The command, e.g. ``'poll'``.
+
+    Returns:
+        tuple<bool, str>: A tuple ``(succeeded, output)``, where
+        ``succeeded`` indicates whether the command succeeded and
+        ``output`` is its output or, on failure, the error message.
+
+    Raises:
+        socket.timeout: If the daemon takes longer than ``_TIMEOUT``
+            seconds to respond.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(_TIMEOUT)
+        sock.connect(_SOCKET_FILENAME)
+        sock.sendall('{:s}\n'.format(command).encode())
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    status, _, output = b''.join(chunks).decode().partition('\n')
+    return status == 'ok', output
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        raise ValueError(
+            'battery_client.py accepts exactly one argument: the command to '
+            'send to battery_control.py')
+    try:
+        succeeded, output = send_command(sys.argv[1])
+    except socket.timeout:
+        succeeded = False
+        output = 'Timed out waiting for battery_control.py daemon\n'
+    except OSError:
+        succeeded = False
+        output = 'battery_control.py daemon is not running at {:s}\n'.format(
+            _SOCKET_FILENAME)
+    if succeeded:
+        sys.stdout.write(output)
+    else:
+        sys.stderr.write(output)
+        sys.exit(1)
@@ -1,16 +1,65 @@
 #!/usr/bin/python3
 import asyncio
+import atexit
+import contextlib
+import copy
 from datetime import datetime
 from datetime import timedelta
+import functools
+import io
 import json
 import os
+import socket
+import socketserver
+import struct
 import subprocess
 import sys
+import time
+import traceback
 
-from filelock import SoftFileLock
+from filelock import FileLock
 from kasa import SmartPlug
 import psutil
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Constants from the Linux headers linux/netlink.h, linux/genetlink.h, and
+# linux/nl80211.h, which we use to query nl80211 in _ssid_linux()
+_NETLINK_GENERIC = 16
+_NLM_F_REQUEST = 0x1
+_NLMSG_ERROR = 0x2
+_NLA_TYPE_MASK = 0x3fff
+_GENL_ID_CTRL = 0x10
+_CTRL_CMD_GETFAMILY = 3
+_CTRL_ATTR_FAMILY_ID = 1
+_CTRL_ATTR_FAMILY_NAME = 2
+_NL80211_CMD_GET_INTERFACE = 5
+_NL80211_ATTR_IFINDEX = 3
+_NL80211_ATTR_SSID = 52
+
+
+def _ttl_cache(ttl):
+    """Return a decorator that caches a function's return value.
+
+    The decorated function must not take any arguments. Its return value
+    is reused until ``ttl`` seconds have elapsed since we computed it.
+    """
+    def decorator(function):
+        # A list of the form [expires_at, value], or [] if nothing is cached
+        cache = []
+
+        @functools.wraps(function)
+        def wrapper():
+            now = time.monotonic()
+            if not cache or now >= cache[0]:
+                cache[:] = [now + ttl, function()]
+            return cache[1]
+        return wrapper
+    return decorator
+
 
 class BatteryController:
     """Manages whether we are charging the laptop battery.
@@ -44,8 +93,10 @@ class BatteryController:
     #     manualOverrideState. The manual override expires after a while, in
     #     case I forget to explicitly turn it off when it is no longer needed.
     #
-    # Times are represented as ISO 8601 strings returned by
-    # datetime.isoformat().
+    # Times are represented as Unix timestamps, as returned by time.time().
+    # Older versions of BatteryController represented them as ISO 8601 strings
+    # returned by datetime.isoformat(); _read_state() converts these to
+    # timestamps.
 
     # The battery charge percentage below which we normally switch from
     # discharging to charging. This should be less than _CHARGE_THRESHOLD.
@@ -88,12 +139,53 @@ class BatteryController:
     # The static IP address of the smart plug
     _PLUG_IP_ADDRESS = '192.168.1.123'
 
+    # The MAC address of the smart plug, in lowercase. We use this to
+    # distinguish the smart plug from other devices with the IP address
+    # _PLUG_IP_ADDRESS on other networks.
+    _PLUG_MAC_ADDRESS = 'aa:bb:cc:dd:ee:ff'
+
+    # The TCP port on which the smart plug listens for commands
+    _PLUG_PORT = 9999
+
+    # The Unix domain socket on which daemon() listens for commands. This
+    # should match _SOCKET_FILENAME in battery_client.py.
+    _SOCKET_FILENAME = '/path/to/battery_control.sock'
+
     # The SSID of my home Wi-Fi network. If the laptop is not connected to this
     # network, then ``BatteryController`` ceases to operate. This is because
     # the laptop is unable to communicate with the smart plug, and because it's
     # not plugged into it.
     _HOME_SSID = 'HomeSSID'
 
+    # The number of seconds for which to reuse the results of _ssid() and
+    # _battery_percent(). This spares us from repeatedly computing them in a
+    # single operation, while ensuring that they stay current if a process
+    # runs for a long time.
+    _CACHE_TTL = 2
+
+    # The event loop we use to communicate with the smart plug, or None if we
+    # have not created it yet. We reuse a single event loop and a single
+    # SmartPlug object (_plug) so that operations that communicate with the
+    # smart plug more than once, such as scan(), only need to set them up
+    # once.
+    _loop = None
+
+    # The SmartPlug object for the smart plug, or None if we have not created
+    # it yet. See the comments for _loop.
+    _plug = None
+
+    # Information about _STATE_FILENAME as of the last time we read or wrote
+    # it, or None if we haven't read or written it. This enables _read_state()
+    # to avoid re-parsing the file if it hasn't changed, and it enables
+    # _write_state() to skip writing the file when the state hasn't changed.
+    # It is a dictionary with the following entries:
+    #
+    # contents: The contents of the file, as returned by _serialize_state().
+    # fileKey: A tuple (st_ino, st_mtime_ns) for the file. If this changes,
+    #     then the file has changed since we cached it.
+    # state: The state information stored in the file.
+    _state_cache = None
+
     @staticmethod
     def _lock_filename():
         """Return the lock file protecting ``BatteryController``'s state.
@@ -112,23 +204,91 @@ class BatteryController:
             'defaultState': True,
         }
 
+    @staticmethod
+    def _serialize_state(state):
+        """Return the contents of ``_STATE_FILENAME`` for the given state.
+
+        We store the state compactly, since ``print_status()`` is
+        responsible for displaying it in a human-readable format.
+
+        Returns:
+            bytes: The contents.
+        """
+        if orjson is not None:
+            return orjson.dumps(state, option=orjson.OPT_SORT_KEYS)
+        else:
+            return json.dumps(
+                state, separators=(',', ':'), sort_keys=True).encode()
+
+    @staticmethod
+    def _state_file_key():
+        """Return the ``fileKey`` entry for ``_state_cache``.
+
+        Returns:
+            tuple: The key, or None if ``_STATE_FILENAME`` does not
+            exist.
+        """
+        try:
+            stat = os.stat(BatteryController._STATE_FILENAME)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
     @staticmethod
     def _read_state():
         """Return the current state information, stored in ``_STATE_FILENAME``.
         """
-        if not os.path.isfile(BatteryController._STATE_FILENAME):
+        file_key = BatteryController._state_file_key()
+        if file_key is None:
             return BatteryController._default_state()
+
+        cache = BatteryController._state_cache
+        if cache is not None and cache['fileKey'] == file_key:
+            return copy.copy(cache['state'])
+
+        with open(BatteryController._STATE_FILENAME, 'rb') as file:
+            contents = file.read()
+        if orjson is not None:
+            state = orjson.loads(contents)
         else:
-            with open(BatteryController._STATE_FILENAME, 'r') as file:
-                return json.load(file)
+            state = json.loads(contents)
+
+        for key in ['keepStateUntil', 'manualOverrideStateExpiresAt']:
+            if isinstance(state.get(key), str):
+                state[key] = datetime.fromisoformat(state[key]).timestamp()
+        BatteryController._state_cache = {
+            'contents': contents,
+            'fileKey': file_key,
+            'state': copy.copy(state),
+        }
+        return state
 
     @staticmethod
     def _write_state(state):
-        """Save the specified state information in ``_STATE_FILENAME``."""
-        with open(BatteryController._STATE_FILENAME, 'w') as file:
-            file.write(json.dumps(state, indent=4, sort_keys=True))
+        """Save the specified state information in ``_STATE_FILENAME``.
+
+        If the file already has the same contents, this does nothing.
+        """
+        contents = BatteryController._serialize_state(state)
+        cache = BatteryController._state_cache
+        if (cache is not None and contents == cache['contents'] and
+                cache['fileKey'] == BatteryController._state_file_key()):
+            return
+
+        # Write to a temporary file and then move it into place, so that the
+        # state file is never partially written
+        temp_filename = '{:s}.tmp'.format(BatteryController._STATE_FILENAME)
+        with open(temp_filename, 'wb') as file:
+            file.write(contents)
+        os.replace(temp_filename, BatteryController._STATE_FILENAME)
+        BatteryController._state_cache = {
+            'contents': contents,
+            'fileKey': BatteryController._state_file_key(),
+            'state': copy.copy(state),
+        }
 
     @staticmethod
+    @_ttl_cache(_CACHE_TTL)
     def _ssid():
         """Return the SSID for the Wi-Fi network we are connected to, if any.
         """
@@ -149,6 +309,11 @@ class BatteryController:
                     return stripped_line[index + 2:]
             return None
         else:
+            try:
+                return BatteryController._ssid_linux()
+            except OSError:
+                pass
+
             output = subprocess.check_output(['/sbin/iwgetid', '-r']).decode()
             ssid = output.rstrip('\n')
             if ssid:
@@ -157,28 +322,219 @@ class BatteryController:
                 return None
 
     @staticmethod
-    def _ping_plug():
+    @_ttl_cache(_CACHE_TTL)
+    def _battery_percent():
+        """Return the battery's current charge percentage."""
+        return psutil.sensors_battery().percent
+
+    @staticmethod
+    def _genl_request(sock, family_id, command, attributes):
+        """Send a generic netlink request and return the response.
+
+        Arguments:
+            sock (socket): A ``NETLINK_GENERIC`` netlink socket.
+            family_id (int): The ID of the generic netlink family.
+            command (int): The command to send.
+            attributes (list<tuple<int, bytes>>): The attributes to
+                include in the request, as pairs of the attribute type
+                and the attribute's payload.
+
+        Returns:
+            dict<int, bytes>: A map from each attribute type in the
+            response to the attribute's payload.
+
+        Raises:
+            OSError: If the kernel responds with an error.
+        """
+        payload = struct.pack('=BBH', command, 1, 0)
+        for attribute_type, value in attributes:
+            attribute = (
+                struct.pack('=HH', 4 + len(value), attribute_type) + value)
+            payload += attribute + b'\0' * (-len(attribute) % 4)
+        sock.send(
+            struct.pack(
+                '=IHHII', 16 + len(payload), family_id, _NLM_F_REQUEST, 1,
+                0) +
+            payload)
+
+        response = sock.recv(65536)
+        length, message_type = struct.unpack_from('=IH', response)
+        if message_type == _NLMSG_ERROR:
+            error = -struct.unpack_from('=i', response, 16)[0]
+            raise OSError(error, os.strerror(error))
+
+        # Skip the netlink and generic netlink headers
+        offset = 20
+        response_attributes = {}
+        while offset + 4 <= length:
+            attribute_length, attribute_type = struct.unpack_from(
+                '=HH', response, offset)
+            if attribute_length < 4:
+                break
+            response_attributes[attribute_type & _NLA_TYPE_MASK] = (
+                response[offset + 4:offset + attribute_length])
+            offset += (attribute_length + 3) & ~3
+        return response_attributes
+
+    @staticmethod
+    def _ssid_linux():
+        """Return the SSID for the Wi-Fi network we are connected to, if any.
+
+        This is the same as ``_ssid()``, but it queries the kernel using
+        nl80211 over netlink rather than running ``iwgetid``, so it
+        doesn't have to start a subprocess. It only works on Linux.
+
+        Raises:
+            OSError: If we fail to query nl80211.
+        """
+        with socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_GENERIC) as sock:
+            sock.settimeout(1)
+            response = BatteryController._genl_request(
+                sock, _GENL_ID_CTRL, _CTRL_CMD_GETFAMILY,
+                [(_CTRL_ATTR_FAMILY_NAME, b'nl80211\0')])
+            family_id = struct.unpack('=H', response[_CTRL_ATTR_FAMILY_ID])[0]
+
+            for name in sorted(os.listdir('/sys/class/net')):
+                if not os.path.isdir(
+                        os.path.join('/sys/class/net', name, 'wireless')):
+                    continue
+                index = socket.if_nametoindex(name)
+                response = BatteryController._genl_request(
+                    sock, family_id, _NL80211_CMD_GET_INTERFACE,
+                    [(_NL80211_ATTR_IFINDEX, struct.pack('=I', index))])
+                ssid = response.get(_NL80211_ATTR_SSID)
+                if ssid:
+                    return ssid.decode()
+            return None
+
+    @staticmethod
+    def _plug_in_arp_cache():
+        """Return whether the smart plug has an entry in the ARP cache.
+
+        The entry must match both ``_PLUG_IP_ADDRESS`` and
+        ``_PLUG_MAC_ADDRESS``. This only works on Linux, where it reads
+        ``/proc/net/arp``. On other platforms, it returns False.
+        """
+        try:
+            with open('/proc/net/arp', 'r') as file:
+                lines = file.read().split('\n')[1:]
+        except OSError:
+            return False
+
+        for line in lines:
+            fields = line.split()
+            if (len(fields) >= 4 and
+                    fields[0] == BatteryController._PLUG_IP_ADDRESS and
+                    int(fields[2], 16) != 0 and
+                    fields[3].lower() == BatteryController._PLUG_MAC_ADDRESS):
+                return True
+        return False
+
+    @staticmethod
+    def _is_home_network():
+        """Return whether we are connected to the home Wi-Fi network.
+
+        If the smart plug is in the ARP cache, we were recently
+        communicating with it, so we can skip the comparatively
+        expensive ``_ssid()`` call. The converse doesn't hold: ARP
+        entries expire, so otherwise we fall back to checking the SSID.
+        """
+        return (
+            BatteryController._plug_in_arp_cache() or
+            BatteryController._ssid() == BatteryController._HOME_SSID)
+
+    @staticmethod
+    async def _probe_plug():
         """Raise a ``RuntimeError`` if we fail to communicate with the plug.
 
-        Calling ``_ping_plug()`` before calling ``SmartPlug`` methods
-        may enable us to fail faster.
+        This opens and immediately closes a TCP connection to the plug's
+        ``_PLUG_PORT``. Calling ``_probe_plug()`` before calling
+        ``SmartPlug`` methods may enable us to fail faster.
         """
-        if os.name == 'nt':
-            command = [
-                'ping', '/n', '1', '/w', '600',
-                BatteryController._PLUG_IP_ADDRESS]
-        else:
-            command = [
-                'timeout', '0.6', 'ping', '-c', '1',
-                BatteryController._PLUG_IP_ADDRESS]
-
-        # Attempt to ping the plug three times
-        for i in range(3):
-            process = subprocess.run(
-                command, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-            if process.returncode == 0:
-                return
-        raise RuntimeError('Unable to reach the smart plug')
+        # Attempt to connect to the plug three times concurrently, and succeed
+        # as soon as any of the attempts succeeds
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 0.6
+        pending = {
+            asyncio.ensure_future(
+                asyncio.open_connection(
+                    BatteryController._PLUG_IP_ADDRESS,
+                    BatteryController._PLUG_PORT))
+            for i in range(3)}
+        done = set()
+        try:
+            while pending and not any(
+                    not task.exception() for task in done):
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                newly_done, pending = await asyncio.wait(
+                    pending, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                done |= newly_done
+        finally:
+            for task in pending:
+                task.cancel()
+
+        succeeded = False
+        for task in done:
+            if not task.exception():
+                _, writer = task.result()
+                writer.close()
+                with contextlib.suppress(OSError):
+                    await writer.wait_closed()
+                succeeded = True
+        if not succeeded:
+            raise RuntimeError('Unable to reach the smart plug')
+
+    @staticmethod
+    async def _connect_and_act(operation):
+        """Call the specified ``SmartPlug`` method, after probing the plug.
+
+        Arguments:
+            operation (str): The name of the ``SmartPlug`` coroutine
+                method to call, e.g. ``'turn_on'``.
+
+        Returns:
+            SmartPlug: The plug we called the method on.
+
+        Raises:
+            Exception: If we fail to communicate with the smart plug.
+        """
+        await BatteryController._probe_plug()
+        if BatteryController._plug is None:
+            BatteryController._plug = SmartPlug(
+                BatteryController._PLUG_IP_ADDRESS)
+        await getattr(BatteryController._plug, operation)()
+        return BatteryController._plug
+
+    @staticmethod
+    def _run(coroutine):
+        """Run the specified coroutine in ``_loop`` and return its result.
+        """
+        if BatteryController._loop is None:
+            BatteryController._loop = asyncio.new_event_loop()
+            atexit.register(BatteryController._close_loop)
+        return BatteryController._loop.run_until_complete(coroutine)
+
+    @staticmethod
+    def _close_loop():
+        """Shut down and close ``_loop``.
+
+        This performs the same cleanup as ``asyncio.run()``: it cancels
+        any remaining tasks and waits for them to finish, and it
+        finalizes asynchronous generators.
+        """
+        loop = BatteryController._loop
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+        BatteryController._loop = None
 
     @staticmethod
     def _turn_off():
@@ -187,8 +543,7 @@ class BatteryController:
         Raises:
             Exception: If we fail to communicate with the smart plug.
         """
-        BatteryController._ping_plug()
-        asyncio.run(SmartPlug(BatteryController._PLUG_IP_ADDRESS).turn_off())
+        BatteryController._run(BatteryController._connect_and_act('turn_off'))
 
     @staticmethod
     def _turn_on():
@@ -197,8 +552,7 @@ class BatteryController:
         Raises:
             Exception: If we fail to communicate with the smart plug.
         """
-        BatteryController._ping_plug()
-        asyncio.run(SmartPlug(BatteryController._PLUG_IP_ADDRESS).turn_on())
+        BatteryController._run(BatteryController._connect_and_act('turn_on'))
 
     @staticmethod
     def _poll(status):
@@ -217,24 +571,21 @@ class BatteryController:
                 applied to this state. The ``_poll`` method may alter
                 the value of ``status``.
         """
-        if BatteryController._ssid() != BatteryController._HOME_SSID:
+        if not BatteryController._is_home_network():
             BatteryController._write_state(status)
             return
 
-        now = datetime.now()
+        now = time.time()
         if 'manualOverrideState' in status:
-            expires_at = datetime.fromisoformat(
-                status['manualOverrideStateExpiresAt'])
-            if now >= expires_at:
+            if now >= status['manualOverrideStateExpiresAt']:
                 status.pop('manualOverrideState')
                 status.pop('manualOverrideStateExpiresAt')
         if 'keepStateUntil' in status:
-            keep_state_until = datetime.fromisoformat(status['keepStateUntil'])
-            if now >= keep_state_until:
+            if now >= status['keepStateUntil']:
                 status.pop('keepStateUntil')
 
         if 'keepStateUntil' not in status:
-            battery = psutil.sensors_battery().percent
+            battery = BatteryController._battery_percent()
             if status['defaultState']:
                 if battery >= BatteryController._CHARGE_THRESHOLD:
                     status['defaultState'] = False
@@ -266,7 +617,7 @@ class BatteryController:
                 # --- Mutate status here ---
                 BatteryController._poll(status)
         """
-        return SoftFileLock(BatteryController._lock_filename(), timeout=30)
+        return FileLock(BatteryController._lock_filename(), timeout=30)
 
     @staticmethod
     def _optimistic_lock():
@@ -282,7 +633,7 @@ class BatteryController:
                 # --- Mutate status here ---
                 BatteryController._poll(status)
         """
-        return SoftFileLock(BatteryController._lock_filename())
+        return FileLock(BatteryController._lock_filename(), timeout=0)
 
     @staticmethod
     def poll():
@@ -299,9 +650,11 @@ class BatteryController:
     @staticmethod
     def print_status():
         """Output status information about ``BatteryController`` to stdout."""
-        print(
-            json.dumps(
-                BatteryController._read_state(), indent=4, sort_keys=True))
+        status = BatteryController._read_state()
+        for key in ['keepStateUntil', 'manualOverrideStateExpiresAt']:
+            if key in status:
+                status[key] = datetime.fromtimestamp(status[key]).isoformat()
+        print(json.dumps(status, indent=4, sort_keys=True))
 
     @staticmethod
     def enable_manual_override():
@@ -315,9 +668,10 @@ class BatteryController:
         with BatteryController._lock():
             status = BatteryController._read_state()
             expires_at = (
-                datetime.now() + BatteryController._MANUAL_OVERRIDE_INTERVAL)
+                time.time() +
+                BatteryController._MANUAL_OVERRIDE_INTERVAL.total_seconds())
             status['manualOverrideState'] = True
-            status['manualOverrideStateExpiresAt'] = expires_at.isoformat()
+            status['manualOverrideStateExpiresAt'] = expires_at
             BatteryController._poll(status)
 
     @staticmethod
@@ -338,14 +692,15 @@ class BatteryController:
         state of the smart plug, so ``prepare_for_sleep()`` decides
         whether to charge the battery while the laptop is asleep.
         """
-        battery = psutil.sensors_battery().percent
+        battery = BatteryController._battery_percent()
         with BatteryController._lock():
             status = BatteryController._read_state()
             keep_state_until = (
-                datetime.now() + BatteryController._SLEEP_INTERVAL)
+                time.time() +
+                BatteryController._SLEEP_INTERVAL.total_seconds())
             status['defaultState'] = (
                 battery <= BatteryController._SLEEP_CHARGE_THRESHOLD)
-            status['keepStateUntil'] = keep_state_until.isoformat()
+            status['keepStateUntil'] = keep_state_until
             BatteryController._poll(status)
 
     @staticmethod
@@ -361,24 +716,108 @@ class BatteryController:
         turns it on or off, we should call ``scan()`` to ensure that
         ``BatteryController`` picks up the change.
         """
-        BatteryController._ping_plug()
-        plug = SmartPlug(BatteryController._PLUG_IP_ADDRESS)
-        asyncio.run(plug.update())
+        plug = BatteryController._run(
+            BatteryController._connect_and_act('update'))
         with BatteryController._lock():
             status = BatteryController._read_state()
             status['currentState'] = plug.is_on
             BatteryController._poll(status)
 
+    @staticmethod
+    def _commands():
+        """Return the commands that ``battery_control.py`` accepts.
+
+        Returns:
+            dict<str, callable>: A map from each command to the function
+            that performs it. The ``'daemon'`` command is only accepted
+            on the command line, not by ``daemon()``.
+        """
+        return {
+            'daemon': BatteryController.daemon,
+            'info': BatteryController.print_status,
+            'override-off': BatteryController.disable_manual_override,
+            'override-on': BatteryController.enable_manual_override,
+            'poll': BatteryController.poll,
+            'scan': BatteryController.scan,
+            'status': BatteryController.print_status,
+        }
+
+    @staticmethod
+    def daemon():
+        """Run a server that performs commands sent by ``battery_client.py``.
+
+        The server listens on the Unix domain socket ``_SOCKET_FILENAME``
+        and runs until it is killed. Running commands this way rather
+        than by running ``battery_control.py`` directly spares us from
+        paying for starting Python and importing ``kasa`` and ``psutil``
+        each time, and it enables us to reuse cached information such as
+        ``_state_cache`` and ``_plug``. This is not supported on Windows.
+        """
+        if os.path.exists(BatteryController._SOCKET_FILENAME):
+            # Refuse to take over the socket from a daemon that is already
+            # running. Otherwise, the socket is left over from a daemon that
+            # exited, so we remove it.
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(BatteryController._SOCKET_FILENAME)
+                except ConnectionRefusedError:
+                    pass
+                else:
+                    raise RuntimeError(
+                        'Another daemon is already listening on {:s}'.format(
+                            BatteryController._SOCKET_FILENAME))
+            os.remove(BatteryController._SOCKET_FILENAME)
+        with socketserver.UnixStreamServer(
+                BatteryController._SOCKET_FILENAME,
+                _DaemonRequestHandler) as server:
+            server.serve_forever()
+
+
+class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Handles a connection to ``BatteryController.daemon()``.
+
+    The client sends a command followed by a newline. We respond with
+    ``'ok'`` or ``'error'``, a newline, and then the command's output or
+    the error message.
+    """
+
+    # The number of seconds to wait for the client before giving up. The
+    # daemon handles one connection at a time, so this prevents a
+    # misbehaving client from blocking all subsequent commands.
+    timeout = 60
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            return
+        if not line:
+            # The client disconnected without sending a command, e.g. because
+            # daemon() was checking whether we are running
+            return
+
+        command = line.decode().strip()
+        methods = BatteryController._commands()
+        output = io.StringIO()
+        if command not in methods or command == 'daemon':
+            response = 'error\nUnknown command {:s}\n'.format(repr(command))
+        else:
+            try:
+                with contextlib.redirect_stdout(output):
+                    methods[command]()
+            except Exception:
+                response = 'error\n{:s}'.format(traceback.format_exc())
+            else:
+                response = 'ok\n{:s}'.format(output.getvalue())
+        try:
+            self.wfile.write(response.encode())
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting for the response
+            pass
+
 
 if __name__ == '__main__':
-    methods = {
-        'info': BatteryController.print_status,
-        'override-off': BatteryController.disable_manual_override,
-        'override-on': BatteryController.enable_manual_override,
-        'poll': BatteryController.poll,
-        'scan': BatteryController.scan,
-        'status': BatteryController.print_status,
-    }
+    methods = BatteryController._commands()
     if len(sys.argv) != 2 or sys.argv[1] not in methods:
         raise ValueError(
             'battery_control.py accepts exactly one argument. It must be one '